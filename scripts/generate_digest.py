@@ -7,6 +7,8 @@ Generates daily digest from recent summaries and sends email.
 import os
 import sys
 import json
+import functools
+import uuid
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -15,7 +17,10 @@ PROJECT_DIR = Path(__file__).parent.parent
 load_dotenv(PROJECT_DIR / '.env.local')
 
 import requests
+from requests.adapters import HTTPAdapter
+from jinja2 import Environment, FileSystemLoader
 from supabase import create_client
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # Configuration
 SUPABASE_URL = os.getenv('NEXT_PUBLIC_SUPABASE_URL')
@@ -24,11 +29,32 @@ RESEND_API_KEY = os.getenv('RESEND_API_KEY')
 DIGEST_EMAIL_TO_ENV = os.getenv('DIGEST_EMAIL_TO', 'youearnedit@gmail.com')
 DIGEST_EMAIL_FROM = os.getenv('DIGEST_EMAIL_FROM', 'ACR Intel Agent <acr-intel@mail.ipguy.co>')
 
+# Keep-alive session for the Resend API
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
-def get_digest_recipients():
+def is_transient_error(e):
+    """Resend is retried on connection errors, 429 and 5xx; other 4xx mean the request itself is bad"""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, requests.RequestException)
+
+RESEND_RETRY = retry(stop=stop_after_attempt(4), wait=wait_exponential(min=1, max=30), retry=retry_if_exception(is_transient_error), reraise=True)
+
+# Email template is compiled once; autoescape keeps feed titles/summaries HTML-safe
+TEMPLATE_DIR = Path(__file__).parent / 'templates'
+EMAIL_TEMPLATE = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True,
+).get_template('digest.html.j2')
+
+
+@functools.lru_cache(maxsize=1)
+def get_digest_recipients(supabase):
     """Get recipients from database with env var fallback"""
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
         result = supabase.table('settings') \
             .select('value') \
             .eq('key', 'digest_recipients') \
@@ -48,22 +74,17 @@ def get_recent_summaries(supabase, hours=24):
     summary_cutoff = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
     pub_cutoff = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
 
+    # The inner join drops summaries whose item is filtered out, so old publications
+    # never leave the database. Items without a publication date are kept.
     result = supabase.table('summaries').select(
         'summary,why_it_matters,category,topics,relevance_score,must_read,created_at,'
-        'item:items(id,title,url,published_at)'
-    ).gte('created_at', summary_cutoff).order('relevance_score', desc=True).execute()
-
-    # Filter out items with old publication dates
-    filtered = []
-    for s in result.data:
-        item = s.get('item')
-        if item:
-            pub_date = item.get('published_at')
-            if pub_date and pub_date < pub_cutoff:
-                continue
-        filtered.append(s)
+        'item:items!inner(id,title,url,published_at)'
+    ).gte('created_at', summary_cutoff) \
+        .or_(f'published_at.gte.{pub_cutoff},published_at.is.null', reference_table='item') \
+        .order('relevance_score', desc=True) \
+        .execute()
 
-    return filtered
+    return result.data
 
 def build_digest(summaries):
     """Build digest content from summaries"""
@@ -94,9 +115,18 @@ def build_digest(summaries):
     high_threshold = max(max_score * 0.7, 60)
     mid_threshold = max(max_score * 0.4, 30)
 
-    must_know = [i for i in items if i['must_read'] or i['relevance_score'] >= high_threshold][:3]
-    worth_a_look = [i for i in items if not i['must_read'] and mid_threshold <= i['relevance_score'] < high_threshold][:7]
-    quick_hits = [i for i in items if 0 < i['relevance_score'] < mid_threshold][:10]
+    # Single pass over the sorted items; an item can land in more than one bucket
+    must_know, worth_a_look, quick_hits = [], [], []
+    for i in items:
+        score = i['relevance_score']
+        if len(must_know) < 3 and (i['must_read'] or score >= high_threshold):
+            must_know.append(i)
+        if len(worth_a_look) < 7 and not i['must_read'] and mid_threshold <= score < high_threshold:
+            worth_a_look.append(i)
+        if len(quick_hits) < 10 and 0 < score < mid_threshold:
+            quick_hits.append(i)
+        if len(must_know) == 3 and len(worth_a_look) == 7 and len(quick_hits) == 10:
+            break
 
     if not must_know and worth_a_look:
         must_know = worth_a_look[:2]
@@ -110,59 +140,18 @@ def build_digest(summaries):
 
 def format_email_html(date, content):
     """Format digest as HTML email"""
-    html = f"""
-    <html>
-    <body style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-        <h1 style="color: #1a1a1a; border-bottom: 2px solid #0066cc; padding-bottom: 10px;">
-            ACR Industry Intelligence - {date}
-        </h1>
-    """
-
-    if content['must_know']:
-        html += '<h2 style="color: #cc0000;">&#x1F6A8; Critical Updates</h2>'
-        for item in content['must_know']:
-            cat_badge = f'<span style="background: #eee; padding: 2px 6px; border-radius: 3px; font-size: 11px; margin-left: 8px;">{item["category"].upper()}</span>'
-            html += f"""
-            <div style="margin-bottom: 20px; padding: 15px; background: #f8f9fa; border-left: 4px solid #cc0000;">
-                <h3 style="margin: 0 0 10px 0;"><a href="{item['url']}" style="color: #1a1a1a; text-decoration: none;">{item['title']}</a>{cat_badge}</h3>
-                <p style="margin: 0 0 10px 0; color: #333;">{item['summary']}</p>
-                <p style="margin: 0; color: #666; font-style: italic;">ACR Impact: {item['why_it_matters']}</p>
-            </div>
-            """
-
-    if content['worth_a_look']:
-        html += '<h2 style="color: #0066cc;">&#x1F4CB; Industry Watch</h2>'
-        for item in content['worth_a_look']:
-            html += f"""
-            <div style="margin-bottom: 15px; padding: 10px; background: #f8f9fa;">
-                <h4 style="margin: 0 0 5px 0;"><a href="{item['url']}" style="color: #1a1a1a;">{item['title']}</a></h4>
-                <p style="margin: 0; color: #666; font-size: 14px;">{item['summary']}</p>
-            </div>
-            """
-
-    if content['quick_hits']:
-        html += '<h2 style="color: #666;">&#x26A1; Quick Hits</h2><ul>'
-        for item in content['quick_hits']:
-            html += f'<li><a href="{item["url"]}">{item["title"]}</a></li>'
-        html += '</ul>'
-
-    html += """
-        <hr style="margin-top: 30px; border: none; border-top: 1px solid #ddd;">
-        <p style="color: #999; font-size: 12px;">Generated by ACR Intel Agent</p>
-    </body>
-    </html>
-    """
-    return html
-
-def send_email(date, content):
-    """Send digest email via Resend"""
-    recipients = get_digest_recipients()
+    return EMAIL_TEMPLATE.render(date=date, **content)
 
-    response = requests.post(
+@RESEND_RETRY
+def send_email(date, content, recipients, idempotency_key):
+    """Send digest email via Resend"""
+    response = _session.post(
         'https://api.resend.com/emails',
         headers={
             'Authorization': f'Bearer {RESEND_API_KEY}',
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            # One key per run, so Resend drops a retried POST it already accepted
+            'Idempotency-Key': idempotency_key,
         },
         json={
             'from': DIGEST_EMAIL_FROM,
@@ -172,6 +161,8 @@ def send_email(date, content):
         }
     )
 
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
     return response.status_code == 200, response.text
 
 def main():
@@ -211,19 +202,21 @@ def main():
         sys.exit(1)
 
     print("\n3. Saving digest to database...")
-    supabase.table('digests').delete().eq('date', today).execute()
-
-    result = supabase.table('digests').insert({
+    result = supabase.table('digests').upsert({
         'date': today,
         'content': content,
         'email_sent': False,
-    }).execute()
+    }, on_conflict='date').execute()
     print(f"   Saved digest ID: {result.data[0]['id']}")
 
     print("\n4. Sending email...")
-    success, response = send_email(today, content)
+    recipients = get_digest_recipients(supabase)
+    idempotency_key = f'digest-{today}-{uuid.uuid4()}'
+    try:
+        success, response = send_email(today, content, recipients, idempotency_key)
+    except requests.RequestException as e:
+        success, response = False, e
     if success:
-        recipients = get_digest_recipients()
         print(f"   Email sent to {len(recipients)} recipients")
         supabase.table('digests').update({'email_sent': True}).eq('date', today).execute()
     else:
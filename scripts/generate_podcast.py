@@ -7,7 +7,9 @@ Generates a two-host podcast (Marcus & Priya) covering SAR/ELT/EPIRB/PLB industr
 import os
 import sys
 import json
+import errno
 import shutil
+import uuid
 from datetime import datetime
 from pathlib import Path
 
@@ -23,7 +25,9 @@ load_dotenv(PROJECT_DIR / '.env.local')
 
 from podcastfy.client import generate_podcast
 import requests
+from requests.adapters import HTTPAdapter
 from supabase import create_client
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # Configuration
 SUPABASE_URL = os.getenv('NEXT_PUBLIC_SUPABASE_URL')
@@ -32,6 +36,19 @@ RESEND_API_KEY = os.getenv('RESEND_API_KEY')
 DIGEST_EMAIL_TO_ENV = os.getenv('DIGEST_EMAIL_TO', 'youearnedit@gmail.com')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+def is_transient_error(e):
+    """Transient Resend failures: connection errors, 429 and 5xx"""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, requests.RequestException)
+
+
+RESEND_RETRY = retry(stop=stop_after_attempt(4), wait=wait_exponential(min=1, max=30), retry=retry_if_exception(is_transient_error), reraise=True)
+
 
 def get_digest_recipients():
     """Get recipients from database with env var fallback"""
@@ -55,6 +72,10 @@ def get_digest_recipients():
 OUTPUT_DIR = Path(__file__).parent.parent / 'podcasts'
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Supabase Storage bucket for podcast audio; emails link to a signed URL
+PODCAST_BUCKET = 'podcasts'
+PODCAST_LINK_EXPIRES = 7 * 24 * 3600
+
 
 def get_latest_digest():
     """Fetch the latest digest from Supabase"""
@@ -117,6 +138,16 @@ That's The ACR Report for today. Stay ahead of regulatory changes, track competi
     return text
 
 
+def move_audio(src, dst):
+    """Rename the audio file into place, copying only when it's on another filesystem"""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
 def generate_podcast_audio(text_content, output_path):
     """Generate podcast audio using Podcastfy with Edge TTS (free)"""
 
@@ -190,7 +221,7 @@ DYNAMIC:
 
         # Move the generated file to our desired output path
         if audio_file and Path(audio_file).exists():
-            shutil.move(audio_file, output_path)
+            move_audio(audio_file, output_path)
             return str(output_path)
         return audio_file
 
@@ -206,29 +237,34 @@ DYNAMIC:
             api_key_label="ANTHROPIC_API_KEY"
         )
         if audio_file and Path(audio_file).exists():
-            shutil.move(audio_file, output_path)
+            move_audio(audio_file, output_path)
             return str(output_path)
         return audio_file
 
 
-def send_podcast_email(audio_path, date):
-    """Send the podcast as an email attachment using Resend"""
+def upload_podcast(audio_path, date):
+    """Upload the podcast to Supabase Storage and return a signed download URL"""
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    bucket = supabase.storage.from_(PODCAST_BUCKET)
+    storage_path = f'acr-intel-{date}.mp3'
 
-    # Read the audio file
     with open(audio_path, 'rb') as f:
-        audio_data = f.read()
+        bucket.upload(storage_path, f, {'content-type': 'audio/mpeg', 'upsert': 'true'})
 
-    import base64
-    audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+    signed = bucket.create_signed_url(storage_path, PODCAST_LINK_EXPIRES)
+    return signed['signedURL']
 
-    # Get recipients from database (with env var fallback)
-    recipients = get_digest_recipients()
 
-    response = requests.post(
+@RESEND_RETRY
+def send_podcast_email(audio_url, date, recipients, idempotency_key):
+    """Send the podcast download link by email using Resend"""
+    response = _session.post(
         'https://api.resend.com/emails',
         headers={
             'Authorization': f'Bearer {RESEND_API_KEY}',
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            # One key per run, so Resend drops a retried POST it already accepted
+            'Idempotency-Key': idempotency_key,
         },
         json={
             'from': 'ACR Intel Agent <acr-intel@mail.ipguy.co>',
@@ -238,19 +274,18 @@ def send_podcast_email(audio_path, date):
                 <h1>🎙️ The ACR Report Podcast</h1>
                 <p>Marcus and Priya break down today's key developments in SAR, aviation, maritime, and the broader safety equipment industry.</p>
                 <p><strong>Date:</strong> {date}</p>
-                <p>The audio file is attached to this email. Listen to stay ahead of regulatory changes, competitor moves, and industry trends.</p>
+                <p><a href="{audio_url}">Listen to today's episode</a> to stay ahead of regulatory changes, competitor moves, and industry trends. The link expires in 7 days.</p>
                 <hr>
                 <p style="color: #666; font-size: 12px;">
                     The ACR Report — Industry intelligence for aerospace & marine safety
                 </p>
             ''',
-            'attachments': [{
-                'filename': f'acr-intel-{date}.mp3',
-                'content': audio_base64
-            }]
         }
     )
 
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+
     if response.status_code == 200:
         print(f"Podcast email sent successfully to {len(recipients)} recipients")
         return True
@@ -292,9 +327,27 @@ def main():
         print(f"   Error: {e}")
         sys.exit(1)
 
+    # Upload to storage so the email only carries a link
+    print("\n4. Uploading podcast...")
+    try:
+        audio_url = upload_podcast(output_path, date)
+        print(f"   Uploaded to {PODCAST_BUCKET} bucket")
+    except Exception as e:
+        print(f"   Error: {e}")
+        sys.exit(1)
+
     # Send email
-    print("\n4. Sending podcast via email...")
-    if send_podcast_email(output_path, date):
+    print("\n5. Sending podcast via email...")
+    # Get recipients from database (with env var fallback)
+    recipients = get_digest_recipients()
+    idempotency_key = f'podcast-{date}-{uuid.uuid4()}'
+    try:
+        sent = send_podcast_email(audio_url, date, recipients, idempotency_key)
+    except requests.RequestException as e:
+        print(f"Failed to send email: {e}")
+        sent = False
+
+    if sent:
         print("   Success!")
     else:
         print("   Failed to send email")
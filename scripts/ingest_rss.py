@@ -5,22 +5,163 @@ Fetches RSS feeds directly to Supabase, bypassing Vercel timeout limits.
 """
 
 import os
+import logging
 import sys
 import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from email.message import Message
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urljoin
 
 from dotenv import load_dotenv
 PROJECT_DIR = Path(__file__).parent.parent
 load_dotenv(PROJECT_DIR / '.env.local')
 
 import feedparser
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
+import requests
+from requests.adapters import HTTPAdapter
 from supabase import create_client
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+logging.basicConfig(stream=sys.stdout, level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(message)s')
+log = logging.getLogger(__name__)
 
 # Configuration
 SUPABASE_URL = os.getenv('NEXT_PUBLIC_SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
 
+# Feeds are fetched concurrently over one pooled session
+MAX_WORKERS = 16
+FETCH_TIMEOUT = 15
+
+# Stored content is plain text, capped just above what summarize.py sends to Claude
+CONTENT_MAX_CHARS = 5000
+
+_session = requests.Session()
+_session.headers['User-Agent'] = feedparser.USER_AGENT
+_session.mount('https://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+_session.mount('http://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+
+def is_transient_error(e):
+    """Feed downloads are retried on connection errors, 429 and 5xx; a 404 or 403 is final"""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, requests.RequestException)
+
+FETCH_RETRY = retry(stop=stop_after_attempt(4), wait=wait_exponential(min=1, max=30), retry=retry_if_exception(is_transient_error), reraise=True)
+
+# Plain RSS 2.0 and Atom feeds are parsed with lxml; feedparser handles the rest
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+CONTENT_NS = '{http://purl.org/rss/1.0/modules/content/}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+@FETCH_RETRY
+def fetch(url):
+    """Download raw feed bytes along with the headers feedparser needs for charset and base URL"""
+    response = _session.get(url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    headers['content-location'] = urljoin(response.url, headers.get('content-location', ''))
+    return response.content, headers
+
+def header_charset(headers):
+    """Charset declared in the Content-Type header, if any"""
+    message = Message()
+    message['content-type'] = headers.get('content-type', '')
+    return message.get_content_charset()
+
+def parse_timestamp(text):
+    """Parse an RFC 822 or ISO 8601 feed date into a UTC struct_time"""
+    if not text:
+        return None
+    text = text.strip()
+    try:
+        dt = parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).timetuple()
+
+def resolve(el, href):
+    """Resolve a link against the element's xml:base, or the feed URL if none is set"""
+    return urljoin(el.base or '', href.strip())
+
+def rss_entry(item):
+    """Convert an RSS 2.0 <item> into a feedparser-style entry"""
+    entry = feedparser.FeedParserDict(
+        published_parsed=parse_timestamp(item.findtext('pubDate') or item.findtext(f'{DC_NS}date')),
+    )
+    title = item.find('title')
+    if title is not None:
+        entry['title'] = (title.text or '').strip()
+
+    # Like feedparser, a permalink guid stands in for a missing <link>
+    link = item.find('link')
+    guid = item.find('guid')
+    if link is not None and (link.text or '').strip():
+        entry['link'] = resolve(link, link.text)
+    elif guid is not None and (guid.text or '').strip() and guid.get('isPermaLink', 'true').lower() != 'false':
+        entry['link'] = resolve(guid, guid.text)
+
+    encoded = item.findtext(f'{CONTENT_NS}encoded')
+    if encoded:
+        entry['content'] = [{'value': encoded}]
+    description = item.findtext('description')
+    if description is not None:
+        entry['summary'] = description
+    return entry
+
+def element_text(el):
+    """All text inside an element, including child markup such as Atom xhtml content"""
+    return ''.join(el.itertext()) if el is not None else None
+
+def atom_entry(item):
+    """Convert an Atom <entry> into a feedparser-style entry"""
+    entry = feedparser.FeedParserDict(
+        published_parsed=parse_timestamp(item.findtext(f'{ATOM_NS}published')),
+        updated_parsed=parse_timestamp(item.findtext(f'{ATOM_NS}updated')),
+    )
+    title = item.find(f'{ATOM_NS}title')
+    if title is not None:
+        entry['title'] = element_text(title).strip()
+    for link in item.iterfind(f'{ATOM_NS}link'):
+        if link.get('rel', 'alternate') == 'alternate' and link.get('href'):
+            entry['link'] = resolve(link, link.get('href'))
+            break
+
+    content = element_text(item.find(f'{ATOM_NS}content'))
+    if content:
+        entry['content'] = [{'value': content}]
+    summary = element_text(item.find(f'{ATOM_NS}summary'))
+    if summary is not None:
+        entry['summary'] = summary
+    return entry
+
+def parse_entries(content, headers):
+    """Parse feed entries with lxml, falling back to feedparser for anything else"""
+    charset = header_charset(headers)
+    try:
+        # lxml rejects charsets libxml2 doesn't know here, which sends the feed to feedparser
+        parser = etree.XMLParser(resolve_entities=False, no_network=True, encoding=charset) if charset else _XML_PARSER
+        root = etree.fromstring(content, parser=parser, base_url=headers.get('content-location'))
+        if root.tag == 'rss':
+            return [rss_entry(item) for item in root.iterfind('channel/item')]
+        if root.tag == f'{ATOM_NS}feed':
+            return [atom_entry(item) for item in root.iterfind(f'{ATOM_NS}entry')]
+    except (etree.XMLSyntaxError, ValueError, AttributeError, LookupError):
+        pass
+    return feedparser.parse(content, response_headers=headers).entries
+
 def parse_date(entry):
     """Parse date from feed entry"""
     for attr in ['published_parsed', 'updated_parsed', 'created_parsed']:
@@ -32,52 +173,76 @@ def parse_date(entry):
                 pass
     return datetime.now(timezone.utc).isoformat()
 
+def html_to_text(html):
+    """Strip markup so downstream summaries send Claude plain text"""
+    tree = LexborHTMLParser(html)
+    tree.strip_tags(['script', 'style'])
+    return ' '.join(tree.text(separator=' ').split())
+
 def get_content(entry):
-    """Extract content from entry"""
+    """Extract plain-text content from entry"""
+    html = ''
     if hasattr(entry, 'content') and entry.content:
-        return entry.content[0].get('value', '')[:10000]
-    if hasattr(entry, 'summary'):
-        return entry.summary[:10000]
-    if hasattr(entry, 'description'):
-        return entry.description[:10000]
-    return ''
+        html = entry.content[0].get('value', '')
+    elif hasattr(entry, 'summary'):
+        html = entry.summary
+    elif hasattr(entry, 'description'):
+        html = entry.description
+    return html_to_text(html)[:CONTENT_MAX_CHARS] if html else ''
+
+def upsert_items(supabase, rows):
+    """Upsert items in one request, falling back to per-row upserts on failure"""
+    try:
+        return supabase.table('items').upsert(rows, on_conflict='url', ignore_duplicates=True).execute().data
+    except Exception as e:
+        log.warning("Batch upsert failed (%s), retrying row by row", e)
+
+    saved = []
+    for row in rows:
+        try:
+            saved += supabase.table('items').upsert(row, on_conflict='url', ignore_duplicates=True).execute().data
+        except Exception as e:
+            log.error("[%s]: %s", row['url'], e)
+    return saved
 
 def main():
-    print("=" * 50)
-    print("ACR Intel Agent - RSS Ingest")
-    print("=" * 50)
+    log.info("ACR Intel Agent - RSS Ingest")
 
     if not all([SUPABASE_URL, SUPABASE_KEY]):
-        print("ERROR: Missing Supabase credentials")
+        log.error("Missing Supabase credentials")
         sys.exit(1)
 
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
     cutoff = datetime.now(timezone.utc) - timedelta(days=7)
 
     # Get enabled sources
-    print("\n1. Fetching enabled sources...")
+    log.info("1. Fetching enabled sources...")
     sources = supabase.table('sources').select('*').eq('enabled', True).execute()
-    print(f"   Found {len(sources.data)} enabled sources")
+    log.info("Found %d enabled sources", len(sources.data))
 
-    # Get existing URLs
-    print("\n2. Checking existing items...")
-    existing = supabase.table('items').select('url').execute()
-    existing_urls = set(item['url'] for item in existing.data)
-    print(f"   Found {len(existing_urls)} existing items")
+    # Only items inside the ingest window can collide with feed entries, so skip
+    # re-sending those and leave anything older to the UNIQUE(url) constraint
+    log.info("2. Checking recent items...")
+    recent_cutoff = (datetime.now(timezone.utc) - timedelta(days=8)).isoformat()
+    existing = supabase.table('items').select('url').gte('published_at', recent_cutoff).execute()
+    seen_urls = set(item['url'] for item in existing.data)
+    log.info("Found %d recent items", len(seen_urls))
 
     # Process feeds
-    print("\n3. Processing RSS feeds...")
-    total_new = 0
+    log.info("3. Processing RSS feeds...")
+    new_items = []
     total_skipped = 0
 
-    for source in sources.data:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        downloads = [(source, executor.submit(fetch, source['url'])) for source in sources.data]
+
+    for source, download in downloads:
         try:
-            feed = feedparser.parse(source['url'])
-            new_count = 0
+            entries = parse_entries(*download.result())
 
-            for entry in feed.entries[:20]:
+            for entry in entries[:20]:
                 url = entry.get('link', '')
-                if not url or url in existing_urls:
+                if not url or url in seen_urls:
                     continue
 
                 pub_date = parse_date(entry)
@@ -89,29 +254,34 @@ def main():
                 except:
                     pass
 
-                item = {
+                new_items.append({
                     'source_id': source['id'],
                     'title': entry.get('title', 'Untitled')[:500],
                     'url': url,
                     'content': get_content(entry),
                     'published_at': pub_date,
                     'fetched_at': datetime.now(timezone.utc).isoformat(),
-                }
+                })
+                seen_urls.add(url)
 
-                supabase.table('items').insert(item).execute()
-                existing_urls.add(url)
-                new_count += 1
+        except Exception as e:
+            log.error("[%s]: %.50s", source['name'], e)
 
-            if new_count > 0:
-                print(f"   [{source['category']}] {source['name']}: +{new_count} items")
-            total_new += new_count
+    log.info("Found %d candidate items", len(new_items))
 
-        except Exception as e:
-            print(f"   ERROR [{source['name']}]: {str(e)[:50]}")
+    # Save items, letting the UNIQUE(url) constraint drop already-ingested entries
+    log.info("4. Saving new items...")
+    total_new = 0
+    if new_items:
+        saved = upsert_items(supabase, new_items)
+        total_new = len(saved)
+
+        new_by_source = Counter(item['source_id'] for item in saved)
+        for source in sources.data:
+            if new_by_source[source['id']]:
+                log.info("[%s] %s: +%d items", source['category'], source['name'], new_by_source[source['id']])
 
-    print(f"\n" + "=" * 50)
-    print(f"SUMMARY: {total_new} new items, {total_skipped} skipped (old)")
-    print("=" * 50)
+    log.info("SUMMARY: %d new items, %d skipped (old)", total_new, total_skipped)
 
 if __name__ == '__main__':
     main()
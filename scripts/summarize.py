@@ -5,9 +5,12 @@ Uses Claude to summarize new items for ACR Electronics business intelligence.
 """
 
 import os
+import logging
 import sys
-import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -16,19 +19,40 @@ load_dotenv(PROJECT_DIR / '.env.local')
 
 from supabase import create_client
 import anthropic
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+logging.basicConfig(stream=sys.stdout, level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+log = logging.getLogger(__name__)
 
 # Configuration
 SUPABASE_URL = os.getenv('NEXT_PUBLIC_SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 
+# Summaries are written in batches to avoid one round trip per item
+INSERT_BATCH_SIZE = 25
+
+# Claude calls are I/O bound, so run several at once within the account's rate limit
+MAX_WORKERS = 8
+ANTHROPIC_RPM = int(os.getenv('ANTHROPIC_RPM', '50'))
+_rate_lock = threading.Lock()
+_next_request_at = 0.0
+
+def is_transient_error(e):
+    """Claude calls are retried on connection errors, 429 and 5xx (including 529 overloaded)"""
+    if isinstance(e, anthropic.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, anthropic.APIConnectionError)
+
+CLAUDE_RETRY = retry(stop=stop_after_attempt(4), wait=wait_exponential(min=1, max=30), retry=retry_if_exception(is_transient_error), reraise=True)
+
 SUMMARIZATION_PROMPT = """You are summarizing news for ACR Electronics, a company that manufactures:
 - EPIRBs (Emergency Position Indicating Radio Beacons) for maritime
 - ELTs (Emergency Locator Transmitters) for aviation
 - PLBs (Personal Locator Beacons) for outdoor/marine safety
 - GMDSS equipment for commercial vessels
 
-Given the title and content below, return a JSON object with:
+Given the title and content below, call the emit_summary tool with:
 {
   "summary": "One clear sentence summarizing what this is about",
   "why_it_matters": "Max 25 words on why this matters to ACR Electronics' business",
@@ -56,109 +80,157 @@ Scoring for ACR relevance:
 
 Rules:
 - must_read = true ONLY for: beacon regulations, Cospas-Sarsat updates, competitor news, major FAA/IMO changes
-- hype_flag = true if: vague claims, no concrete details
-- Return ONLY valid JSON, no markdown"""
+- hype_flag = true if: vague claims, no concrete details"""
+
+ITEM_CATEGORIES = ['market', 'technology', 'supply_chain', 'trade', 'regulatory', 'competitor']
+
+# Forcing this tool makes Claude return the summary as schema-shaped input, so no JSON parsing is needed
+SUMMARY_TOOL = {
+    'name': 'emit_summary',
+    'description': 'Record the ACR Electronics summary for a news item',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'summary': {'type': 'string'},
+            'why_it_matters': {'type': 'string'},
+            'category': {'type': 'string', 'enum': ITEM_CATEGORIES},
+            'topics': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 3},
+            'relevance_score': {'type': 'integer', 'minimum': 0, 'maximum': 100},
+            'must_read': {'type': 'boolean'},
+            'hype_flag': {'type': 'boolean'},
+        },
+        'required': ['summary', 'why_it_matters', 'category', 'topics', 'relevance_score', 'must_read', 'hype_flag'],
+    },
+}
 
+def wait_for_rate_limit():
+    """Space out Claude requests so all workers together stay under ANTHROPIC_RPM"""
+    global _next_request_at
+    interval = 60.0 / ANTHROPIC_RPM
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + interval
+    if wait > 0:
+        time.sleep(wait)
+
+def get_source_category(item):
+    """Get the category of the item's source, defaulting to sar"""
+    source = item.get('source')
+    if isinstance(source, list) and source:
+        return source[0].get('category', 'sar')
+    if isinstance(source, dict):
+        return source.get('category', 'sar')
+    return 'sar'
+
+@CLAUDE_RETRY
 def summarize_item(client, title, content, source_category='sar'):
     """Use Claude to summarize an item"""
     truncated_content = content[:4000] if content else '(No content - summarize based on title)'
 
+    wait_for_rate_limit()
+
     message = client.messages.create(
         model='claude-sonnet-4-20250514',
         max_tokens=500,
-        system=SUMMARIZATION_PROMPT,
+        # Every call shares the tool definition and system prompt, so cache that prefix
+        system=[{'type': 'text', 'text': SUMMARIZATION_PROMPT, 'cache_control': {'type': 'ephemeral'}}],
+        tools=[SUMMARY_TOOL],
+        tool_choice={'type': 'tool', 'name': 'emit_summary'},
         messages=[{
             'role': 'user',
             'content': f"Title: {title}\n\nSource category: {source_category}\n\nContent:\n{truncated_content}"
         }]
     )
 
-    response_text = message.content[0].text if message.content else ''
-
+    tool_use = next((block for block in message.content if block.type == 'tool_use'), None)
+    if tool_use is None:
+        raise ValueError(f"No emit_summary tool call in response (stop_reason={message.stop_reason})")
+    result = tool_use.input
+
+    category = result.get('category')
+    if category not in ITEM_CATEGORIES:
+        category = 'market'
+
+    return {
+        'summary': str(result.get('summary', 'No summary available')),
+        'why_it_matters': str(result.get('why_it_matters', 'Significance unclear')),
+        'category': category,
+        'topics': result.get('topics', [])[:3],
+        'relevance_score': min(100, max(0, int(result.get('relevance_score', 50)))),
+        'must_read': bool(result.get('must_read', False)),
+        'hype_flag': bool(result.get('hype_flag', False)),
+    }
+
+def insert_summaries(supabase, rows):
+    """Insert summaries in one request, falling back to per-row inserts on failure"""
     try:
-        import re
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if not json_match:
-            raise ValueError('No JSON found')
-
-        result = json.loads(json_match.group())
-
-        valid_categories = ['sar', 'aviation', 'maritime', 'manufacturing', 'geopolitical', 'competitor', 'customer']
-        category = result.get('category', 'sar')
-        if category not in valid_categories:
-            category = 'sar'
-
-        return {
-            'summary': str(result.get('summary', 'No summary available')),
-            'why_it_matters': str(result.get('why_it_matters', 'Significance unclear')),
-            'category': category,
-            'topics': result.get('topics', [])[:3],
-            'relevance_score': min(100, max(0, int(result.get('relevance_score', 50)))),
-            'must_read': bool(result.get('must_read', False)),
-            'hype_flag': bool(result.get('hype_flag', False)),
-        }
+        supabase.table('summaries').insert(rows).execute()
+        return len(rows), 0
     except Exception as e:
-        print(f"     Parse error: {e}")
-        return {
-            'summary': title,
-            'why_it_matters': 'Unable to analyze significance',
-            'category': 'sar',
-            'topics': [],
-            'relevance_score': 30,
-            'must_read': False,
-            'hype_flag': False,
-        }
+        log.warning("Batch insert failed (%s), retrying row by row", e)
+
+    inserted = 0
+    for row in rows:
+        try:
+            supabase.table('summaries').insert(row).execute()
+            inserted += 1
+        except Exception as e:
+            log.error("[%s]: %s", row['item_id'], e)
+    return inserted, len(rows) - inserted
 
 def main():
-    print("=" * 50)
-    print("ACR Intel Agent - Summarization")
-    print("=" * 50)
+    log.info("ACR Intel Agent - Summarization")
 
     if not all([SUPABASE_URL, SUPABASE_KEY, ANTHROPIC_API_KEY]):
-        print("ERROR: Missing required credentials")
+        log.error("Missing required credentials")
         sys.exit(1)
 
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-
-    # Get existing summary IDs
-    print("\n1. Checking existing summaries...")
-    existing = supabase.table('summaries').select('item_id').execute()
-    summarized_ids = set(s['item_id'] for s in existing.data)
-    print(f"   Found {len(summarized_ids)} existing summaries")
-
-    # Get items without summaries
-    print("\n2. Fetching items to summarize...")
-    items = supabase.table('items').select(
+    # tenacity on summarize_item is the only retry layer, so each attempt goes through the rate limiter
+    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+
+    # Get items without summaries (anti-join done by the unsummarized_items view).
+    # Older items would be dropped by the digest's 7-day cutoff, so don't spend Claude calls on them.
+    log.info("1. Fetching items to summarize...")
+    pub_cutoff = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+    items = supabase.table('unsummarized_items').select(
         'id,title,content,url,source:sources(name,category)'
-    ).order('published_at', desc=True).limit(100).execute()
+    ).or_(f'published_at.gte.{pub_cutoff},published_at.is.null') \
+        .order('published_at', desc=True) \
+        .limit(50) \
+        .execute()
 
-    items_to_summarize = [i for i in items.data if i['id'] not in summarized_ids][:50]
-    print(f"   Found {len(items_to_summarize)} items to summarize")
+    items_to_summarize = items.data
+    log.info("Found %d items to summarize", len(items_to_summarize))
 
     if not items_to_summarize:
-        print("   No new items to summarize")
+        log.info("No new items to summarize")
         return
 
     # Process items
-    print("\n3. Summarizing items...")
+    log.info("2. Summarizing items...")
     successful = 0
     failed = 0
+    pending = []
 
-    for i, item in enumerate(items_to_summarize):
-        try:
-            source = item.get('source')
-            source_category = 'sar'
-            if source:
-                if isinstance(source, list) and source:
-                    source_category = source[0].get('category', 'sar')
-                elif isinstance(source, dict):
-                    source_category = source.get('category', 'sar')
-
-            print(f"   [{i+1}/{len(items_to_summarize)}] {item['title'][:50]}...")
-            summary = summarize_item(client, item['title'], item.get('content', ''), source_category)
-
-            supabase.table('summaries').insert({
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(summarize_item, client, item['title'], item.get('content', ''), get_source_category(item)): item
+            for item in items_to_summarize
+        }
+
+        for i, future in enumerate(as_completed(futures)):
+            item = futures[future]
+            log.info("[%d/%d] %.50s...", i + 1, len(items_to_summarize), item['title'])
+            try:
+                summary = future.result()
+            except Exception as e:
+                log.error("[%s]: %s", item['id'], e)
+                failed += 1
+                continue
+
+            pending.append({
                 'item_id': item['id'],
                 'summary': summary['summary'],
                 'why_it_matters': summary['why_it_matters'],
@@ -167,20 +239,20 @@ def main():
                 'relevance_score': summary['relevance_score'],
                 'must_read': summary['must_read'],
                 'hype_flag': summary['hype_flag'],
-            }).execute()
+            })
 
-            successful += 1
+            if len(pending) >= INSERT_BATCH_SIZE:
+                inserted, errors = insert_summaries(supabase, pending)
+                successful += inserted
+                failed += errors
+                pending = []
 
-            if (i + 1) % 5 == 0:
-                time.sleep(1)
-
-        except Exception as e:
-            print(f"     ERROR: {e}")
-            failed += 1
+    if pending:
+        inserted, errors = insert_summaries(supabase, pending)
+        successful += inserted
+        failed += errors
 
-    print(f"\n" + "=" * 50)
-    print(f"SUMMARY: {successful} successful, {failed} failed")
-    print("=" * 50)
+    log.info("SUMMARY: %d successful, %d failed", successful, failed)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,6 @@
+-- Private storage bucket for podcast audio
+-- Podcast emails link to a signed URL instead of attaching the MP3
+
+INSERT INTO storage.buckets (id, name, public) VALUES
+  ('podcasts', 'podcasts', false)
+ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,9 @@
+-- Items that do not have a summary yet
+-- Lets the summarizer fetch its work queue without pulling every summary ID
+
+CREATE OR REPLACE VIEW unsummarized_items
+WITH (security_invoker = true) AS
+SELECT items.*
+FROM items
+LEFT JOIN summaries ON summaries.item_id = items.id
+WHERE summaries.item_id IS NULL;